@@ -1,28 +1,52 @@
 import uvicorn
 import logging
-from fastapi import FastAPI, HTTPException, Depends, status, Query
+from fastapi import FastAPI, HTTPException, Depends, status, Query, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict, Any, Optional
-from pydantic import BaseModel, Field, validator, ValidationError
+from typing import Annotated, List, Dict, Any, Optional, Callable, Awaitable, Set, Type, TypeVar
+from pydantic import (
+    AfterValidator, BaseModel, Field, PlainSerializer, PrivateAttr, WithJsonSchema, field_validator, ValidationError
+)
 from datetime import datetime, timezone
 from enum import Enum
 import asyncio
+import hmac
+import importlib.util
+from collections import Counter, OrderedDict, defaultdict
 from contextlib import asynccontextmanager
+from functools import lru_cache
+from itertools import count, islice
 import json
 import os
+import sys
+import threading
+import warnings
+import zlib
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib json module
+    orjson = None
+
 # --- Configuration ---
 class Settings:
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
     HOST = os.getenv("HOST", "0.0.0.0")
     PORT = int(os.getenv("PORT", "8000"))
+    # Catalogs live in process memory and every worker would rewrite the same data
+    # files, so only a single worker is supported until state moves to a shared store
+    WORKERS = int(os.getenv("WORKERS", "1"))
+    ACCESS_LOG = os.getenv("ACCESS_LOG", "false").lower() == "true"
     DATA_DIR = Path(os.getenv("DATA_DIR", "./data"))
     MAX_PRODUCTS = int(os.getenv("MAX_PRODUCTS", "1000"))
     MAX_LINEAGE_ENTRIES = int(os.getenv("MAX_LINEAGE_ENTRIES", "10000"))
+    # Bounds on cached serialized responses kept in memory
+    PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "1024"))
+    LINEAGE_CACHE_SIZE = int(os.getenv("LINEAGE_CACHE_SIZE", "1024"))
     API_KEY = os.getenv("API_KEY", "your-secret-api-key")
+    FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "0.5"))
 
 settings = Settings()
 
@@ -33,6 +57,47 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- JSON Helpers ---
+def _json_default(obj: Any) -> Any:
+    # Match orjson: ISO-8601 timestamps, everything else as a string
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=timezone.utc)
+        return obj.isoformat()
+    return str(obj)
+
+def json_dumps(obj: Any) -> bytes:
+    """Serialize to compact JSON bytes, using orjson when it is available."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
+        except orjson.JSONEncodeError:
+            # e.g. integers wider than 64 bits, which pydantic and stdlib json accept
+            pass
+    return json.dumps(obj, separators=(",", ":"), default=_json_default).encode()
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with json_dumps, bypassing FastAPI's jsonable_encoder"""
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+# --- Clock ---
+# Refreshed by a lifespan task so hot paths read a cached timestamp instead of
+# calling datetime.now(); falls back to the real clock when the ticker is not running
+CLOCK_TICK_SECONDS = 0.001
+_now_cache: Dict[str, Optional[datetime]] = {"t": None}
+
+def utcnow() -> datetime:
+    return _now_cache["t"] or datetime.now(timezone.utc)
+
+async def tick_clock():
+    try:
+        while True:
+            _now_cache["t"] = datetime.now(timezone.utc)
+            await asyncio.sleep(CLOCK_TICK_SECONDS)
+    finally:
+        _now_cache["t"] = None
+
 # --- Enums ---
 class DataProductStatus(str, Enum):
     ACTIVE = "active"
@@ -45,19 +110,53 @@ class LineageType(str, Enum):
     AGGREGATED = "aggregated"
 
 # --- Enhanced Data Models ---
+# `schema` is part of the public API, so keep the field name and silence pydantic's
+# warning that it shadows the deprecated BaseModel.schema() classmethod
+warnings.filterwarnings(
+    "ignore", message='Field name "schema" in "DataProduct', category=UserWarning
+)
+
+# Serialize timestamps with isoformat() (+00:00), matching the json_dumps output
+# used by the pre-serialized GET endpoints. The explicit schema keeps OpenAPI from
+# splitting each model into separate -Input/-Output components.
+def _assume_utc(v: datetime) -> datetime:
+    # Treat naive timestamps as UTC, as orjson's OPT_NAIVE_UTC does, so every path agrees
+    return v.replace(tzinfo=timezone.utc) if v.tzinfo is None else v
+
+IsoDatetime = Annotated[
+    datetime,
+    AfterValidator(_assume_utc),
+    PlainSerializer(lambda v: v.isoformat(), return_type=str, when_used="json"),
+    WithJsonSchema({"type": "string", "format": "date-time"}),
+]
+
 class DataProduct(BaseModel):
-    name: str = Field(..., min_length=1, max_length=100, regex="^[a-zA-Z0-9_-]+$")
+    name: str = Field(..., min_length=1, max_length=100, pattern=r"^[a-zA-Z0-9_-]+$")
     domain: str = Field(..., min_length=1, max_length=50)
     owner: str = Field(..., min_length=1, max_length=100)
     description: str = Field(..., min_length=1, max_length=500)
-    schema: Dict[str, str] = Field(..., min_items=1)
+    schema: Dict[str, str] = Field(..., min_length=1)
     status: DataProductStatus = DataProductStatus.ACTIVE
-    version: str = Field(default="1.0.0", regex="^\\d+\\.\\d+\\.\\d+$")
-    tags: List[str] = Field(default_factory=list, max_items=10)
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    
-    @validator('schema')
+    version: str = Field(default="1.0.0", pattern=r"^\d+\.\d+\.\d+$")
+    tags: List[str] = Field(default_factory=list, max_length=10)
+    created_at: IsoDatetime = Field(default_factory=utcnow)
+    updated_at: IsoDatetime = Field(default_factory=utcnow)
+    # Serialized form, reused across GETs until the product is modified
+    _cached_bytes: Optional[bytes] = PrivateAttr(default=None)
+    # Tags as a set for O(1) membership; private attrs are never serialized
+    _tags_set: frozenset = PrivateAttr(default=frozenset())
+    
+    def model_post_init(self, __context: Any):
+        self._tags_set = frozenset(self.tags)
+    
+    @field_validator('domain')
+    @classmethod
+    def validate_domain(cls, v):
+        # Domains and tags repeat across many products; intern them to share one copy
+        return sys.intern(v)
+    
+    @field_validator('schema')
+    @classmethod
     def validate_schema(cls, v):
         if not v:
             raise ValueError('Schema cannot be empty')
@@ -66,14 +165,20 @@ class DataProduct(BaseModel):
                 raise ValueError('Schema fields must have non-empty names and types')
         return v
     
-    @validator('tags')
+    @field_validator('tags')
+    @classmethod
     def validate_tags(cls, v):
-        return [tag.strip().lower() for tag in v if tag.strip()]
-    
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
+        return [sys.intern(tag.strip().lower()) for tag in v if tag.strip()]
+    
+    def to_json_bytes(self, cache: bool = True) -> bytes:
+        # Read once: the event loop may clear the cache while a save thread is here
+        cached = self._cached_bytes
+        if cached is not None:
+            return cached
+        data = json_dumps(self.model_dump())
+        if cache:
+            self._cached_bytes = data
+        return data
 
 class LineageEntry(BaseModel):
     source: str = Field(..., min_length=1, max_length=100)
@@ -82,29 +187,26 @@ class LineageEntry(BaseModel):
     lineage_type: LineageType = LineageType.DIRECT
     confidence: float = Field(default=1.0, ge=0.0, le=1.0)
     metadata: Dict[str, Any] = Field(default_factory=dict)
-    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    timestamp: IsoDatetime = Field(default_factory=utcnow)
     
-    @validator('source', 'target')
+    @field_validator('source', 'target')
+    @classmethod
     def validate_endpoints(cls, v):
         if not v.strip():
             raise ValueError('Source and target cannot be empty')
         return v.strip()
-    
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
 
 class DataProductUpdate(BaseModel):
     description: Optional[str] = Field(None, max_length=500)
     status: Optional[DataProductStatus] = None
-    tags: Optional[List[str]] = Field(None, max_items=10)
+    tags: Optional[List[str]] = Field(None, max_length=10)
     schema: Optional[Dict[str, str]] = None
     
-    @validator('tags')
+    @field_validator('tags')
+    @classmethod
     def validate_tags(cls, v):
         if v is not None:
-            return [tag.strip().lower() for tag in v if tag.strip()]
+            return [sys.intern(tag.strip().lower()) for tag in v if tag.strip()]
         return v
 
 # --- Response Models ---
@@ -115,16 +217,18 @@ class APIResponse(BaseModel):
 
 class HealthCheck(BaseModel):
     status: str
-    timestamp: datetime
+    timestamp: IsoDatetime
     version: str = "1.0.0"
     total_products: int
     total_lineage_entries: int
 
 # --- Security ---
 security = HTTPBearer()
+_API_KEY_BYTES = settings.API_KEY.encode()
 
 def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)) -> bool:
-    if credentials.credentials != settings.API_KEY:
+    # Constant-time comparison so response timing does not leak the key
+    if not hmac.compare_digest(credentials.credentials.encode(), _API_KEY_BYTES):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API key",
@@ -133,71 +237,178 @@ def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)
     return True
 
 # --- Data Persistence ---
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
 class DataStore:
+    WRITE_BUFFER_SIZE = 64 * 1024
+    LINEAGE_FLUSH_EVERY = 50
+    
     def __init__(self, data_dir: Path):
         self.data_dir = data_dir
         self.data_dir.mkdir(exist_ok=True)
-        self.products_file = self.data_dir / "products.json"
-        self.lineage_file = self.data_dir / "lineage.json"
+        # Both catalogs are stored as one JSON object per line; lineage is append-only
+        self.products_file = self.data_dir / "products.jsonl"
+        self.lineage_file = self.data_dir / "lineage.jsonl"
+        # Pre-JSONL files, imported once when the JSONL file does not exist yet
+        self.legacy_products_file = self.data_dir / "products.json"
+        self.legacy_lineage_file = self.data_dir / "lineage.json"
+        # Set by handlers on mutation; the background flusher persists and clears them
+        self.products_dirty = asyncio.Event()
+        self.lineage_dirty = asyncio.Event()
+        # Keeps a background write and the final save from interleaving on disk;
+        # ordering is up to the lifespan, which awaits in-flight saves first
+        self._write_lock = threading.RLock()
+        self._lineage_log = None
+        self._pending_lineage = 0
+        self._compacting = False
+        # Log lines for entries registered while a compaction is replacing the log
+        self._held_lineage: List[bytes] = []
+    
+    def _write_file(self, path: Path, data: bytes):
+        # Serialize up front and hand the whole payload to a single buffered write,
+        # then swap it into place so readers never see a partially written file
+        tmp_path = path.with_name(path.name + ".tmp")
+        with self._write_lock:
+            with open(tmp_path, 'wb', buffering=self.WRITE_BUFFER_SIZE) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+    
+    def _parse_line(self, path: Path, model: Type[ModelT], line_no: int, line: bytes) -> Optional[ModelT]:
+        try:
+            # pydantic parses the JSON and ISO-8601 timestamps itself, in one pass
+            return model.model_validate_json(line)
+        except ValidationError as e:
+            logger.warning(f"Skipping malformed line {line_no} in {path.name}: {e}")
+            return None
+    
+    def _read_jsonl(self, path: Path, model: Type[ModelT]) -> List[ModelT]:
+        """Read models from a JSONL file line by line, skipping lines that fail to parse"""
+        with open(path, 'rb', buffering=self.WRITE_BUFFER_SIZE) as f:
+            parsed = [
+                self._parse_line(path, model, line_no, line)
+                for line_no, line in enumerate(f, start=1) if line.strip()
+            ]
+        return [item for item in parsed if item is not None]
+    
+    def _read_legacy(self, path: Path, model: Type[ModelT], records: List[Any]) -> List[ModelT]:
+        items = []
+        for i, record in enumerate(records):
+            try:
+                items.append(model.model_validate(record))
+            except ValidationError as e:
+                logger.warning(f"Skipping malformed record {i} in {path.name}: {e}")
+        return items
     
     def save_products(self, products: Dict[str, DataProduct]):
         try:
-            with open(self.products_file, 'w') as f:
-                json.dump(
-                    {k: v.dict() for k, v in products.items()}, 
-                    f, 
-                    indent=2, 
-                    default=str
-                )
+            # Reuse cached bytes but don't populate the cache, which is bounded by the GET paths
+            data = b"".join(product.to_json_bytes(cache=False) + b"\n" for product in products.values())
+            self._write_file(self.products_file, data)
             logger.info(f"Saved {len(products)} products to disk")
         except Exception as e:
             logger.error(f"Failed to save products: {e}")
     
+    async def asave_products(self, products: Dict[str, DataProduct]):
+        await asyncio.to_thread(self.save_products, products)
+    
     def load_products(self) -> Dict[str, DataProduct]:
         try:
             if self.products_file.exists():
-                with open(self.products_file, 'r') as f:
-                    data = json.load(f)
-                    products = {}
-                    for k, v in data.items():
-                        # Convert datetime strings back to datetime objects
-                        if 'created_at' in v:
-                            v['created_at'] = datetime.fromisoformat(v['created_at'].replace('Z', '+00:00'))
-                        if 'updated_at' in v:
-                            v['updated_at'] = datetime.fromisoformat(v['updated_at'].replace('Z', '+00:00'))
-                        products[k] = DataProduct(**v)
-                    logger.info(f"Loaded {len(products)} products from disk")
-                    return products
+                products = {p.name: p for p in self._read_jsonl(self.products_file, DataProduct)}
+                logger.info(f"Loaded {len(products)} products from disk")
+                return products
+            if self.legacy_products_file.exists():
+                records = json.loads(self.legacy_products_file.read_bytes()).values()
+                products = {
+                    p.name: p for p in self._read_legacy(self.legacy_products_file, DataProduct, list(records))
+                }
+                # Write the JSONL file right away so the legacy file is never read again
+                self.save_products(products)
+                logger.warning(
+                    f"Imported {len(products)} products from legacy {self.legacy_products_file.name}; "
+                    f"it is no longer used and can be removed"
+                )
+                return products
         except Exception as e:
             logger.error(f"Failed to load products: {e}")
         return {}
     
-    def save_lineage(self, lineage: List[LineageEntry]):
+    def append_lineage(self, entry: LineageEntry):
         try:
-            with open(self.lineage_file, 'w') as f:
-                json.dump(
-                    [entry.dict() for entry in lineage], 
-                    f, 
-                    indent=2, 
-                    default=str
-                )
-            logger.info(f"Saved {len(lineage)} lineage entries to disk")
+            line = json_dumps(entry.model_dump()) + b"\n"
+            if self._compacting:
+                # The entry isn't in the compaction snapshot; hold it and append it
+                # to the new log once that is in place
+                self._held_lineage.append(line)
+                return
+            self._write_log_line(line)
+        except Exception as e:
+            logger.error(f"Failed to append lineage: {e}")
+    
+    def _write_log_line(self, line: bytes):
+        if self._lineage_log is None:
+            self._lineage_log = open(self.lineage_file, 'ab', buffering=self.WRITE_BUFFER_SIZE)
+        self._lineage_log.write(line)
+        self._pending_lineage += 1
+        if self._pending_lineage >= self.LINEAGE_FLUSH_EVERY:
+            self.flush_lineage()
+    
+    def flush_lineage(self):
+        if self._lineage_log is not None:
+            self._lineage_log.flush()
+        self._pending_lineage = 0
+    
+    def close_lineage(self):
+        if self._lineage_log is not None:
+            self._lineage_log.close()
+            self._lineage_log = None
+        self._pending_lineage = 0
+    
+    def compact_lineage(self, lineage: List[LineageEntry]):
+        """Rewrite the lineage log so it holds exactly the given entries"""
+        try:
+            data = b"".join(json_dumps(entry.model_dump()) + b"\n" for entry in lineage)
+            with self._write_lock:
+                self.close_lineage()
+                self._write_file(self.lineage_file, data)
+            logger.info(f"Compacted {len(lineage)} lineage entries to disk")
         except Exception as e:
-            logger.error(f"Failed to save lineage: {e}")
+            logger.error(f"Failed to compact lineage: {e}")
+    
+    def acompact_lineage(self, lineage: List[LineageEntry]) -> Awaitable[None]:
+        # Flag synchronously, in the same step the caller takes its snapshot, so no
+        # append can reach the old log between the snapshot and the compaction
+        self._compacting = True
+        return self._compact_and_replay(lineage)
+    
+    async def _compact_and_replay(self, lineage: List[LineageEntry]):
+        try:
+            await asyncio.to_thread(self.compact_lineage, lineage)
+        finally:
+            self._compacting = False
+            held, self._held_lineage = self._held_lineage, []
+            try:
+                for line in held:
+                    self._write_log_line(line)
+            except Exception as e:
+                logger.error(f"Failed to append held lineage: {e}")
     
     def load_lineage(self) -> List[LineageEntry]:
         try:
             if self.lineage_file.exists():
-                with open(self.lineage_file, 'r') as f:
-                    data = json.load(f)
-                    lineage = []
-                    for entry_data in data:
-                        # Convert datetime strings back to datetime objects
-                        if 'timestamp' in entry_data:
-                            entry_data['timestamp'] = datetime.fromisoformat(entry_data['timestamp'].replace('Z', '+00:00'))
-                        lineage.append(LineageEntry(**entry_data))
-                    logger.info(f"Loaded {len(lineage)} lineage entries from disk")
-                    return lineage
+                lineage = self._read_jsonl(self.lineage_file, LineageEntry)
+                logger.info(f"Loaded {len(lineage)} lineage entries from disk")
+                return lineage
+            if self.legacy_lineage_file.exists():
+                records = json.loads(self.legacy_lineage_file.read_bytes())
+                lineage = self._read_legacy(self.legacy_lineage_file, LineageEntry, records)
+                # Appends go to the JSONL log, so it must hold the imported entries first
+                self.compact_lineage(lineage)
+                logger.warning(
+                    f"Imported {len(lineage)} lineage entries from legacy {self.legacy_lineage_file.name}; "
+                    f"it is no longer used and can be removed"
+                )
+                return lineage
         except Exception as e:
             logger.error(f"Failed to load lineage: {e}")
         return []
@@ -209,17 +420,164 @@ data_store = DataStore(settings.DATA_DIR)
 data_products: Dict[str, DataProduct] = data_store.load_products()
 lineage: List[LineageEntry] = data_store.load_lineage()
 
+# Product indexes for filtered listing and domain analytics, mapping a key to the
+# matching product names. Filtered results are sorted by registration sequence so
+# they come back in the same order as the unfiltered catalog.
+products_by_domain: Dict[str, Set[str]] = defaultdict(set)
+products_by_status: Dict[DataProductStatus, Set[str]] = defaultdict(set)
+products_by_tag: Dict[str, Set[str]] = defaultdict(set)
+product_seq: Dict[str, int] = {}
+_next_seq = count()
+
+def _index_add(index: Dict[Any, Set[str]], key: Any, name: str):
+    index[key].add(name)
+
+def _index_discard(index: Dict[Any, Set[str]], key: Any, name: str):
+    names = index.get(key)
+    if names is not None:
+        names.discard(name)
+        if not names:
+            del index[key]
+
+def index_product(product: DataProduct):
+    product_seq[product.name] = next(_next_seq)
+    _index_add(products_by_domain, product.domain.lower(), product.name)
+    _index_add(products_by_status, product.status, product.name)
+    for tag in product._tags_set:
+        _index_add(products_by_tag, tag, product.name)
+
+def unindex_product(product: DataProduct):
+    product_seq.pop(product.name, None)
+    _index_discard(products_by_domain, product.domain.lower(), product.name)
+    _index_discard(products_by_status, product.status, product.name)
+    for tag in product._tags_set:
+        _index_discard(products_by_tag, tag, product.name)
+
+for _product in data_products.values():
+    index_product(_product)
+
+# Lineage indexes by endpoint, so upstream/downstream lookups avoid full scans
+by_source: Dict[str, List[LineageEntry]] = defaultdict(list)
+by_target: Dict[str, List[LineageEntry]] = defaultdict(list)
+lineage_type_counts: Counter = Counter()
+
+def index_lineage(entry: LineageEntry):
+    by_source[entry.source].append(entry)
+    by_target[entry.target].append(entry)
+    lineage_type_counts[entry.lineage_type] += 1
+
+def unindex_product_lineage(name: str) -> int:
+    """Drop every indexed entry touching a product; returns how many were removed"""
+    downstream = by_source.pop(name, [])
+    upstream = by_target.pop(name, [])
+    # Self-referencing entries appear in both lists but are only removed once
+    removed = downstream + [entry for entry in upstream if entry.source != name]
+    for entry in downstream:
+        if entry.target != name:
+            _remove_indexed(by_target, entry.target, entry)
+    for entry in upstream:
+        if entry.source != name:
+            _remove_indexed(by_source, entry.source, entry)
+    for entry in removed:
+        lineage_type_counts[entry.lineage_type] -= 1
+    return len(removed)
+
+def _remove_indexed(index: Dict[str, List[LineageEntry]], key: str, entry: LineageEntry):
+    entries = index[key]
+    entries.remove(entry)
+    if not entries:
+        del index[key]
+
+for _entry in lineage:
+    index_lineage(_entry)
+
+# Change counters backing the ETags on list and analytics endpoints. The counters
+# restart at 0 in every process, so tags also carry a per-process token to stay
+# unique across restarts and workers.
+products_version = 0
+lineage_version = 0
+_boot_id = os.urandom(4).hex()
+
+def products_changed():
+    global products_version
+    products_version += 1
+    data_store.products_dirty.set()
+
+def lineage_changed():
+    global lineage_version
+    lineage_version += 1
+    lineage_json.cache_clear()
+
+# Products whose serialized bytes are cached, least recently served first
+serialized_products: "OrderedDict[str, DataProduct]" = OrderedDict()
+
+def product_json(product: DataProduct) -> bytes:
+    """Serialized product, caching the bytes for at most PRODUCT_CACHE_SIZE products"""
+    data = product.to_json_bytes()
+    serialized_products[product.name] = product
+    serialized_products.move_to_end(product.name)
+    if len(serialized_products) > settings.PRODUCT_CACHE_SIZE:
+        _, evicted = serialized_products.popitem(last=False)
+        evicted._cached_bytes = None
+    return data
+
+@lru_cache(maxsize=settings.LINEAGE_CACHE_SIZE)
+def lineage_json(index_name: str, product_name: str) -> bytes:
+    """Serialized upstream/downstream entries; cleared whenever lineage changes"""
+    index = by_target if index_name == "upstream" else by_source
+    return json_dumps([entry.model_dump() for entry in index.get(product_name, [])])
+
+def make_etag(prefix: str, version: int, *params: Any) -> str:
+    # Query parameters are folded in so each filtered view gets its own tag
+    return f'"{prefix}{_boot_id}-{version}-{zlib.crc32(repr(params).encode()):08x}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+# Saves started by the flushers; shielded from cancellation so shutdown can await them
+pending_saves: Set[asyncio.Task] = set()
+
+async def flush_when_dirty(dirty: asyncio.Event, save: Callable[[], Awaitable[None]]):
+    """Persist at most once per FLUSH_INTERVAL, however many mutations arrive in between"""
+    while True:
+        await dirty.wait()
+        await asyncio.sleep(settings.FLUSH_INTERVAL)
+        dirty.clear()
+        task = asyncio.ensure_future(save())
+        pending_saves.add(task)
+        task.add_done_callback(pending_saves.discard)
+        # Cancelling the flusher must not abandon a write still running in a worker thread
+        await asyncio.shield(task)
+
 # --- Startup/Shutdown Events ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting Data Mesh Platform")
     logger.info(f"Loaded {len(data_products)} products and {len(lineage)} lineage entries")
+    clock = asyncio.create_task(tick_clock())
+    # Snapshot the catalogs so the write thread never sees them mutated mid-serialization
+    flushers = [
+        asyncio.create_task(flush_when_dirty(
+            data_store.products_dirty, lambda: data_store.asave_products(dict(data_products))
+        )),
+        asyncio.create_task(flush_when_dirty(
+            data_store.lineage_dirty, lambda: data_store.acompact_lineage(list(lineage))
+        )),
+    ]
     yield
     # Shutdown
     logger.info("Shutting down Data Mesh Platform")
+    for task in (clock, *flushers):
+        task.cancel()
+    await asyncio.gather(clock, *flushers, return_exceptions=True)
+    # Let an in-flight background save finish so its older snapshot can't land after the final one
+    await asyncio.gather(*pending_saves, return_exceptions=True)
     data_store.save_products(data_products)
-    data_store.save_lineage(lineage)
+    data_store.compact_lineage(lineage)
     logger.info("Data saved successfully")
 
 # --- FastAPI App ---
@@ -244,7 +602,12 @@ app.add_middleware(
 async def validation_exception_handler(request, exc):
     return JSONResponse(
         status_code=422,
-        content={"success": False, "message": "Validation error", "errors": exc.errors()}
+        content={
+            "success": False,
+            "message": "Validation error",
+            # Context can hold the raw exception raised by a validator, which isn't JSON serializable
+            "errors": exc.errors(include_url=False, include_context=False)
+        }
     )
 
 @app.exception_handler(HTTPException)
@@ -259,7 +622,7 @@ async def http_exception_handler(request, exc):
 async def health_check():
     return HealthCheck(
         status="healthy",
-        timestamp=datetime.now(timezone.utc),
+        timestamp=utcnow(),
         total_products=len(data_products),
         total_lineage_entries=len(lineage)
     )
@@ -267,77 +630,106 @@ async def health_check():
 # --- Data Product Management ---
 @app.post("/register_product", response_model=APIResponse, dependencies=[Depends(verify_api_key)])
 async def register_product(product: DataProduct):
-    if len(data_products) >= settings.MAX_PRODUCTS:
+    # Bind hot globals to locals once per call
+    products = data_products
+    name = product.name
+    max_products = settings.MAX_PRODUCTS
+    if len(products) >= max_products:
         raise HTTPException(
             status_code=429, 
-            detail=f"Maximum number of products ({settings.MAX_PRODUCTS}) reached"
+            detail=f"Maximum number of products ({max_products}) reached"
         )
     
-    if product.name in data_products:
+    if name in products:
         raise HTTPException(status_code=409, detail="Product already exists")
     
-    data_products[product.name] = product
-    logger.info(f"Registered new product: {product.name} in domain: {product.domain}")
+    products[name] = product
+    index_product(product)
+    logger.info(f"Registered new product: {name} in domain: {product.domain}")
     
-    # Save to disk periodically (every 10 products)
-    if len(data_products) % 10 == 0:
-        data_store.save_products(data_products)
+    products_changed()
     
     return APIResponse(
         success=True,
         message="Product registered successfully",
-        data=product.dict()
+        data=product.model_dump(mode="json")
     )
 
-@app.get("/products", response_model=List[DataProduct])
+@app.get("/products", response_model=List[DataProduct], response_class=FastJSONResponse)
 async def list_products(
     domain: Optional[str] = Query(None, description="Filter by domain"),
     status: Optional[DataProductStatus] = Query(None, description="Filter by status"),
     tag: Optional[str] = Query(None, description="Filter by tag"),
     limit: int = Query(100, ge=1, le=1000, description="Limit number of results"),
-    offset: int = Query(0, ge=0, description="Offset for pagination")
+    offset: int = Query(0, ge=0, description="Offset for pagination"),
+    if_none_match: Optional[str] = Header(None)
 ):
-    products = list(data_products.values())
+    etag = make_etag("p", products_version, domain, status, tag, limit, offset)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
     
-    # Apply filters
+    # Apply filters by intersecting the indexes, starting from the smallest
+    filters = []
     if domain:
-        products = [p for p in products if p.domain.lower() == domain.lower()]
+        filters.append(products_by_domain.get(domain.lower(), set()))
     if status:
-        products = [p for p in products if p.status == status]
+        filters.append(products_by_status.get(status, set()))
     if tag:
-        products = [p for p in products if tag.lower() in p.tags]
+        filters.append(products_by_tag.get(tag.lower(), set()))
     
     # Apply pagination
-    total = len(products)
-    products = products[offset:offset + limit]
+    if filters:
+        filters.sort(key=len)
+        names = sorted(filters[0].intersection(*filters[1:]), key=product_seq.__getitem__)
+        total = len(names)
+        products = [data_products[n] for n in names[offset:offset + limit]]
+    else:
+        total = len(data_products)
+        products = list(islice(data_products.values(), offset, offset + limit))
     
     logger.info(f"Listed {len(products)} products (total: {total})")
-    return products
+    content = b"[" + b",".join(product_json(p) for p in products) + b"]"
+    return Response(content=content, media_type="application/json", headers={"ETag": etag})
 
 @app.get("/product/{name}", response_model=DataProduct)
 async def get_product(name: str):
-    if name not in data_products:
+    product = data_products.get(name)
+    if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    return data_products[name]
+    return Response(content=product_json(product), media_type="application/json")
 
 @app.put("/product/{name}", response_model=APIResponse, dependencies=[Depends(verify_api_key)])
 async def update_product(name: str, update: DataProductUpdate):
-    if name not in data_products:
+    product = data_products.get(name)
+    if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    product = data_products[name]
-    update_data = update.dict(exclude_unset=True)
-    
-    for field, value in update_data.items():
-        setattr(product, field, value)
-    
-    product.updated_at = datetime.now(timezone.utc)
+    update_data = update.model_dump(exclude_unset=True)
+    update_data['updated_at'] = utcnow()
+    # Swap in a new, fully validated instance rather than mutating the product in place,
+    # so invalid updates never reach disk and readers holding the old instance
+    # (e.g. a background save) never see a partial update. Raising ValidationError
+    # here is turned into a 422 by validation_exception_handler.
+    updated = DataProduct.model_validate({**product.model_dump(), **update_data})
+    data_products[name] = updated
+    serialized_products.pop(name, None)
+    
+    # Only move the product between index entries that actually changed
+    if updated.status != product.status:
+        _index_discard(products_by_status, product.status, name)
+        _index_add(products_by_status, updated.status, name)
+    for tag in product._tags_set - updated._tags_set:
+        _index_discard(products_by_tag, tag, name)
+    for tag in updated._tags_set - product._tags_set:
+        _index_add(products_by_tag, tag, name)
+    
+    products_changed()
     logger.info(f"Updated product: {name}")
     
     return APIResponse(
         success=True,
         message="Product updated successfully",
-        data=product.dict()
+        data=updated.model_dump(mode="json")
     )
 
 @app.delete("/product/{name}", response_model=APIResponse, dependencies=[Depends(verify_api_key)])
@@ -345,10 +737,16 @@ async def delete_product(name: str):
     if name not in data_products:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    del data_products[name]
+    unindex_product(data_products.pop(name))
+    serialized_products.pop(name, None)
     # Also remove related lineage entries
     global lineage
-    lineage = [entry for entry in lineage if entry.source != name and entry.target != name]
+    if unindex_product_lineage(name):
+        lineage = [entry for entry in lineage if entry.source != name and entry.target != name]
+        # Dropping entries from the append-only log requires a compaction
+        data_store.lineage_dirty.set()
+        lineage_changed()
+    products_changed()
     
     logger.info(f"Deleted product: {name}")
     
@@ -360,46 +758,59 @@ async def delete_product(name: str):
 # --- Lineage Management ---
 @app.post("/register_lineage", response_model=APIResponse, dependencies=[Depends(verify_api_key)])
 async def register_lineage(entry: LineageEntry):
-    if len(lineage) >= settings.MAX_LINEAGE_ENTRIES:
+    # Bind hot globals to locals once per call
+    entries = lineage
+    products = data_products
+    source, target = entry.source, entry.target
+    max_entries = settings.MAX_LINEAGE_ENTRIES
+    if len(entries) >= max_entries:
         raise HTTPException(
             status_code=429, 
-            detail=f"Maximum number of lineage entries ({settings.MAX_LINEAGE_ENTRIES}) reached"
+            detail=f"Maximum number of lineage entries ({max_entries}) reached"
         )
     
     # Validate that source and target products exist
-    if entry.source not in data_products:
-        raise HTTPException(status_code=400, detail=f"Source product '{entry.source}' not found")
-    if entry.target not in data_products:
-        raise HTTPException(status_code=400, detail=f"Target product '{entry.target}' not found")
-    
-    lineage.append(entry)
-    logger.info(f"Registered lineage: {entry.source} -> {entry.target}")
+    if source not in products:
+        raise HTTPException(status_code=400, detail=f"Source product '{source}' not found")
+    if target not in products:
+        raise HTTPException(status_code=400, detail=f"Target product '{target}' not found")
     
-    # Save to disk periodically (every 50 entries)
-    if len(lineage) % 50 == 0:
-        data_store.save_lineage(lineage)
+    entries.append(entry)
+    index_lineage(entry)
+    data_store.append_lineage(entry)
+    lineage_changed()
+    logger.info(f"Registered lineage: {source} -> {target}")
     
     return APIResponse(
         success=True,
         message="Lineage registered successfully",
-        data=entry.dict()
+        data=entry.model_dump(mode="json")
     )
 
-@app.get("/lineage", response_model=List[LineageEntry])
+@app.get("/lineage", response_model=List[LineageEntry], response_class=FastJSONResponse)
 async def get_lineage(
     source: Optional[str] = Query(None, description="Filter by source"),
     target: Optional[str] = Query(None, description="Filter by target"),
     lineage_type: Optional[LineageType] = Query(None, description="Filter by lineage type"),
     limit: int = Query(100, ge=1, le=1000, description="Limit number of results"),
-    offset: int = Query(0, ge=0, description="Offset for pagination")
+    offset: int = Query(0, ge=0, description="Offset for pagination"),
+    if_none_match: Optional[str] = Header(None)
 ):
-    filtered_lineage = lineage
+    etag = make_etag("l", lineage_version, source, target, lineage_type, limit, offset)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
     
-    # Apply filters
+    # Start from the narrowest index available
     if source:
-        filtered_lineage = [entry for entry in filtered_lineage if entry.source == source]
-    if target:
-        filtered_lineage = [entry for entry in filtered_lineage if entry.target == target]
+        filtered_lineage = by_source.get(source, [])
+        if target:
+            filtered_lineage = [entry for entry in filtered_lineage if entry.target == target]
+    elif target:
+        filtered_lineage = by_target.get(target, [])
+    else:
+        filtered_lineage = lineage
+    
+    # Apply filters
     if lineage_type:
         filtered_lineage = [entry for entry in filtered_lineage if entry.lineage_type == lineage_type]
     
@@ -408,27 +819,28 @@ async def get_lineage(
     filtered_lineage = filtered_lineage[offset:offset + limit]
     
     logger.info(f"Retrieved {len(filtered_lineage)} lineage entries (total: {total})")
-    return filtered_lineage
+    return FastJSONResponse(
+        content=[entry.model_dump() for entry in filtered_lineage],
+        headers={"ETag": etag}
+    )
 
-@app.get("/lineage/upstream/{product_name}", response_model=List[LineageEntry])
+@app.get("/lineage/upstream/{product_name}", response_model=List[LineageEntry], response_class=FastJSONResponse)
 async def get_upstream_lineage(product_name: str):
     """Get all upstream dependencies for a product"""
     if product_name not in data_products:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    upstream = [entry for entry in lineage if entry.target == product_name]
-    logger.info(f"Retrieved {len(upstream)} upstream dependencies for {product_name}")
-    return upstream
+    logger.info(f"Retrieved {len(by_target.get(product_name, []))} upstream dependencies for {product_name}")
+    return Response(content=lineage_json("upstream", product_name), media_type="application/json")
 
-@app.get("/lineage/downstream/{product_name}", response_model=List[LineageEntry])
+@app.get("/lineage/downstream/{product_name}", response_model=List[LineageEntry], response_class=FastJSONResponse)
 async def get_downstream_lineage(product_name: str):
     """Get all downstream dependencies for a product"""
     if product_name not in data_products:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    downstream = [entry for entry in lineage if entry.source == product_name]
-    logger.info(f"Retrieved {len(downstream)} downstream dependencies for {product_name}")
-    return downstream
+    logger.info(f"Retrieved {len(by_source.get(product_name, []))} downstream dependencies for {product_name}")
+    return Response(content=lineage_json("downstream", product_name), media_type="application/json")
 
 # --- Enhanced Domain APIs ---
 @app.get("/sales/orders")
@@ -474,36 +886,50 @@ async def get_marketing_campaigns(
 
 # --- Analytics Endpoints ---
 @app.get("/analytics/domains", response_model=Dict[str, int])
-async def get_domain_analytics():
+async def get_domain_analytics(response: Response, if_none_match: Optional[str] = Header(None)):
     """Get analytics about products per domain"""
-    domain_counts = {}
-    for product in data_products.values():
-        domain_counts[product.domain] = domain_counts.get(product.domain, 0) + 1
-    
-    return domain_counts
+    etag = make_etag("p", products_version, "domains")
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return {domain: len(names) for domain, names in products_by_domain.items()}
 
 @app.get("/analytics/lineage-stats", response_model=Dict[str, Any])
-async def get_lineage_analytics():
+async def get_lineage_analytics(response: Response, if_none_match: Optional[str] = Header(None)):
     """Get analytics about lineage relationships"""
+    etag = make_etag("l", lineage_version, "stats")
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     if not lineage:
         return {"total_entries": 0, "unique_sources": 0, "unique_targets": 0}
     
-    sources = set(entry.source for entry in lineage)
-    targets = set(entry.target for entry in lineage)
-    
+    # The endpoint indexes only hold keys with at least one entry
     return {
         "total_entries": len(lineage),
-        "unique_sources": len(sources),
-        "unique_targets": len(targets),
-        "lineage_types": {lt.value: sum(1 for entry in lineage if entry.lineage_type == lt) for lt in LineageType}
+        "unique_sources": len(by_source),
+        "unique_targets": len(by_target),
+        "lineage_types": {lt.value: lineage_type_counts[lt] for lt in LineageType}
     }
 
 # --- Run the API ---
 if __name__ == "__main__":
+    # Prefer uvloop and httptools (uvicorn[standard]) when they are installed
+    has_uvloop = importlib.util.find_spec("uvloop") is not None
+    has_httptools = importlib.util.find_spec("httptools") is not None
+    if settings.WORKERS != 1:
+        logger.error(
+            f"WORKERS={settings.WORKERS} is not supported: each worker would hold its own "
+            f"catalog and overwrite the shared data files"
+        )
+        sys.exit(1)
+    # Pass the app object so uvicorn doesn't import (and load the catalogs from) this file again
     uvicorn.run(
         app, 
         host=settings.HOST, 
         port=settings.PORT,
+        loop="uvloop" if has_uvloop else "auto",
+        http="httptools" if has_httptools else "auto",
         log_level=settings.LOG_LEVEL.lower(),
-        access_log=True
+        access_log=settings.ACCESS_LOG
     )
\ No newline at end of file